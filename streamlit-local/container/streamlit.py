@@ -9,7 +9,13 @@ from langchain.text_splitter import CharacterTextSplitter
 import httpx
 import json
 import asyncio
+import atexit
+import threading
+import queue
 import urllib.parse
+import hashlib
+import numpy as np
+from collections import deque
 
 # Streamlit app title
 st.title("Retrieval Augmented Generation based on a given pdf")
@@ -20,30 +26,80 @@ MILVUS_PORT = "19530"
 LLAMA_HOST = "llama-service"
 LLAMA_PORT = "8080"
 
-# Function to download and process PDFs
+# Cosine similarity above which a previous answer is reused for a new question
+ANSWER_CACHE_THRESHOLD = 0.95
+# Number of answers remembered per session
+ANSWER_CACHE_SIZE = 20
+
+# Static start of every prompt, kept byte-identical so LLAMA can reuse it
+PROMPT_HEADER = "Instructions: Compose a concise answer to the query using the provided search results, no need to mention you found it in the resuts\n\nSearch results:\n"
+
+# Function to start one event loop on a background thread shared by all sessions,
+# so script threads only submit work to it and never drive it themselves
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def close():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    atexit.register(close)
+    return loop
+
+# Function to create the HTTP client once so connections to LLAMA are reused
+# by every session, and closed on the shared event loop at shutdown
+@st.cache_resource
+def get_llama_client():
+    loop = get_event_loop()
+    client = httpx.AsyncClient(base_url=f"http://{LLAMA_HOST}:{LLAMA_PORT}", timeout=120)
+
+    def close():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop).result()
+
+    atexit.register(close)
+    return client
+
+# Function to load the embedding model once and share it across sessions
+@st.cache_resource
+def get_embeddings():
+    return HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2",
+        cache_folder="/work/", model_kwargs={'device': 'cpu'}, encode_kwargs={'normalize_embeddings': True})
+
+# Function to download and process PDFs, cached per PDF URL
 @st.cache_resource
-def load_and_process_pdfs():
+def load_and_process_pdfs(pdf_url):
     pdf_urls = [
-        os.getenv("PDF_URL")
+        pdf_url
     ]
     # Parse the URL
-    url_parts = urllib.parse.urlparse(os.getenv("PDF_URL"))
+    url_parts = urllib.parse.urlparse(pdf_url)
     # Get the path
     path_query = url_parts.path
     # Split the path into path and filename
     path_filename = os.path.split(path_query)
     # Get the filename
     pdf_names = [os.path.basename(path_filename[1])]
+    # Key the download path and collection on the URL so cache entries never collide
+    url_digest = hashlib.sha256(pdf_url.encode()).hexdigest()[:16]
+    collection_name = f"lighthouse_{url_digest}"
 
     all_docs = []
     
     for url, name in zip(pdf_urls, pdf_names):
-        if not os.path.exists(name):
-            output_path = os.path.join("/tmp/", name)
+        output_path = os.path.join("/tmp/", f"{url_digest}_{name}")
+        if not os.path.exists(output_path):
             st.write(f"Downloading {name}...")
-            res = requests.get(url)
-            with open(output_path, 'wb') as file:
-                file.write(res.content)
+            # Stream the download to disk instead of holding the whole PDF in memory
+            with requests.get(url, stream=True) as res:
+                res.raise_for_status()
+                with open(output_path + ".part", 'wb') as file:
+                    for block in res.iter_content(chunk_size=1024 * 1024):
+                        file.write(block)
+            os.replace(output_path + ".part", output_path)
         
         st.write(f"Processing {name}...")
         loader = PyPDFLoader(output_path)
@@ -53,20 +109,21 @@ def load_and_process_pdfs():
         all_docs.extend(split_docs)
     
     st.write("Embedding documents...")
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2",
-    cache_folder="/work/", model_kwargs={'device': 'cpu'}, encode_kwargs={'normalize_embeddings': True})
+    embeddings = get_embeddings()
     
     st.write("Connecting to Milvus...")
     connections.connect(host=MILVUS_HOST, port=MILVUS_PORT)
-    colls = utility.list_collections()
-    for coll in colls:
-        utility.drop_collection(coll)
+    # Drop this app's collections, including ones left by earlier PDF_URLs,
+    # and rebuild only the current one
+    for coll in utility.list_collections():
+        if coll == "lighthouse" or coll.startswith("lighthouse_"):
+            utility.drop_collection(coll)
     
     st.write("Creating vector store...")
     vector_store = Milvus.from_documents(
         all_docs,
         embedding=embeddings,
-        collection_name="lighthouse",
+        collection_name=collection_name,
         connection_args={"host": MILVUS_HOST, "port": MILVUS_PORT}
     )
     
@@ -75,50 +132,120 @@ def load_and_process_pdfs():
 
 # Function to build prompt
 def build_prompt(question, topn_chunks: list[str]):
-    prompt = "Instructions: Compose a concise answer to the query using the provided search results, no need to mention you found it in the resuts\n\n"
-    prompt += "Search results:\n"
+    parts = [PROMPT_HEADER]
     for chunk in topn_chunks:
-        prompt += f"[Document: {chunk[0].metadata.get('source', 'Unknown')}, Page: {chunk[0].metadata.get('page', 'Unknown')}]: " + chunk[0].page_content.replace("\n", " ") + "\n\n"
-    prompt += f"Query: {question}\n\nAnswer: "
-    return prompt
+        parts.append(f"[Document: {chunk[0].metadata.get('source', 'Unknown')}, Page: {chunk[0].metadata.get('page', 'Unknown')}]: " + chunk[0].page_content.replace("\n", " ") + "\n\n")
+    parts.append(f"Query: {question}\n\nAnswer: ")
+    return "".join(parts)
 
-# Asynchronous function to get LLAMA response
-async def get_llama_response(prompt):
+# Asynchronous generator yielding LLAMA response tokens as they arrive
+async def stream_llama_response(client, prompt):
     json_data = {
         'prompt': prompt,
         'temperature': 0.1,
         'n_predict': 200,
         'stream': True,
+        # Let llama.cpp reuse the KV cache for the shared PROMPT_HEADER prefix
+        'cache_prompt': True,
     }
-    async with httpx.AsyncClient(timeout=120) as client:
-        async with client.stream('POST', f'http://{LLAMA_HOST}:{LLAMA_PORT}/completion', json=json_data) as response:
-            full_response = ""
-            async for chunk in response.aiter_bytes():
-                try:
-                    data = json.loads(chunk.decode('utf-8')[6:])
-                    if data['stop'] is False:
-                        full_response += data['content']
-                except:
-                    pass
-    return full_response
+    async with client.stream('POST', '/completion', json=json_data) as response:
+        # Fail on e.g. 503 while the model is loading or 400 for an oversized prompt
+        response.raise_for_status()
+        # Read whole SSE lines so events split across network chunks are not lost
+        async for line in response.aiter_lines():
+            if line.startswith('error: '):
+                raise RuntimeError(f"LLAMA stream error: {line[7:]}")
+            if not line.startswith('data: '):
+                continue
+            try:
+                data = json.loads(line[6:])
+            except json.JSONDecodeError:
+                continue
+            if 'error' in data:
+                raise RuntimeError(f"LLAMA stream error: {data['error']}")
+            if data['stop'] is False:
+                yield data['content']
+
+# Function to iterate LLAMA tokens synchronously from the shared event loop
+def iter_llama_response(prompt):
+    client = get_llama_client()
+    tokens = queue.Queue()
+
+    async def produce():
+        try:
+            async for token in stream_llama_response(client, prompt):
+                tokens.put(token)
+        finally:
+            tokens.put(None)
+
+    future = asyncio.run_coroutine_threadsafe(produce(), get_event_loop())
+    try:
+        # Prompt evaluation on CPU can take seconds before the first token
+        with st.spinner("Generating answer..."):
+            token = tokens.get()
+        while token is not None:
+            yield token
+            token = tokens.get()
+        future.result()
+    finally:
+        # Stops the request if the run is interrupted, e.g. by a new question
+        future.cancel()
+
+# Function to find the closest previous answer to a semantically equivalent question
+def find_cached_answer(question_embedding):
+    answer_cache = st.session_state.answer_cache
+    if not answer_cache:
+        return None
+    scores = [np.dot(question_embedding, cached_embedding) for cached_embedding, _ in answer_cache]
+    best = int(np.argmax(scores))
+    if scores[best] >= ANSWER_CACHE_THRESHOLD:
+        return answer_cache[best][1]
+    return None
+
+# Function to drop previous answers to semantically equivalent questions
+def forget_cached_answers(question_embedding):
+    answer_cache = st.session_state.answer_cache
+    kept = [entry for entry in answer_cache if np.dot(question_embedding, entry[0]) < ANSWER_CACHE_THRESHOLD]
+    answer_cache.clear()
+    answer_cache.extend(kept)
 
 # Load and process PDFs
 with st.spinner("Loading and processing PDFs... This may take a few minutes."):
-    vector_store = load_and_process_pdfs()
+    vector_store = load_and_process_pdfs(os.getenv("PDF_URL"))
 
-# User input
-question = st.text_input("Enter your question about the pdf you picked:")
+# Answers given in this session, keyed by the normalized question embedding
+st.session_state.setdefault("answer_cache", deque(maxlen=ANSWER_CACHE_SIZE))
 
-if question:
-    # Perform similarity search
-    docs = vector_store.similarity_search_with_score(question, k=3)
-    
-    # Build prompt
-    prompt = build_prompt(question, docs)
-    
-    # Get LLAMA response
-    with st.spinner("Generating answer..."):
-        answer = asyncio.run(get_llama_response(prompt))
-    
-    # Display answer
-    st.write("Answer:", answer)
+# User input, only submitted on Enter or the Ask button
+with st.form("question_form"):
+    question = st.text_input("Enter your question about the pdf you picked:")
+    regenerate = st.checkbox("Generate a new answer instead of reusing an earlier one")
+    submitted = st.form_submit_button("Ask")
+
+if submitted and question:
+    # Embed the question once for both the answer cache and the similarity search
+    question_vector = get_embeddings().embed_query(question)
+    question_embedding = np.asarray(question_vector)
+    question_embedding /= np.linalg.norm(question_embedding)
+    answer = None if regenerate else find_cached_answer(question_embedding)
+
+    if answer is None:
+        # Perform similarity search
+        docs = vector_store.similarity_search_with_score_by_vector(question_vector, k=3)
+        
+        # Build prompt
+        prompt = build_prompt(question, docs)
+        
+        # Stream LLAMA response to the page as tokens arrive
+        st.write("Answer:")
+        answer = st.write_stream(iter_llama_response(prompt))
+        # Only cache real answers so an empty completion is never served again
+        if answer:
+            # A regenerated answer replaces the ones the user chose not to reuse
+            if regenerate:
+                forget_cached_answers(question_embedding)
+            st.session_state.answer_cache.append((question_embedding, answer))
+    else:
+        # Display cached answer
+        st.write("Answer:", answer)
+        st.caption("Answer reused from a similar earlier question.")